@@ -0,0 +1,302 @@
+import argparse
+import bisect
+import contextlib
+import copy
+import io
+import random
+import sys
+import threading
+import time
+from typing import Dict, List, Optional
+
+from .app import AdmissionController, PaymentMethod, ShoppingApp, User, UserType
+
+
+# Default shopper behaviour: relative weights of each operation
+DEFAULT_MIX: Dict[str, float] = {
+    "browse": 50,
+    "add": 30,
+    "remove": 10,
+    "checkout": 10,
+}
+
+PERCENTILES = (50, 95, 99, 99.9)
+
+
+class ZipfSampler:
+    """
+    Samples ranks 0..n-1 with probability proportional to 1 / (rank + 1) ** s.
+
+    Args:
+        n (int): The number of items.
+        s (float): The Zipf exponent. 0 gives a uniform distribution.
+        rng (random.Random): The random generator to draw from.
+    """
+    def __init__(self, n: int, s: float, rng: random.Random):
+        if n <= 0:
+            raise ValueError("Zipf sampler needs at least one item")
+        self.rng = rng
+        self.cum_weights: List[float] = []
+        total = 0.0
+        for rank in range(n):
+            total += 1.0 / (rank + 1) ** s
+            self.cum_weights.append(total)
+
+    def sample(self) -> int:
+        x = self.rng.random() * self.cum_weights[-1]
+        return bisect.bisect_right(self.cum_weights, x)
+
+
+def percentile(sorted_values: List[float], pct: float) -> float:
+    """
+    Returns the nearest-rank percentile of an already sorted list.
+    """
+    if not sorted_values:
+        return 0.0
+    rank = max(1, int(-(-pct * len(sorted_values) // 100)))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+def session_view(shop: ShoppingApp) -> ShoppingApp:
+    """
+    Returns a front-end onto the shop with its own login state.
+
+    The view shares the catalog, users and carts with the original shop, the
+    way several request handlers would share one store, but keeps its own
+    current_user so concurrent shoppers don't log each other out.
+    """
+    view = copy.copy(shop)
+    view.current_user = None
+    return view
+
+
+class LoadReport:
+    """
+    LoadReport class.
+
+    Attributes:
+        latencies (Dict[str, List[float]]): Latencies in seconds for each operation, sorted.
+        failures (Dict[str, int]): The number of calls that returned False or raised, per operation.
+        elapsed (float): The wall-clock duration of the run in seconds.
+    """
+    def __init__(self, latencies: Dict[str, List[float]], failures: Dict[str, int], elapsed: float):
+        self.latencies = {op: sorted(values) for op, values in latencies.items()}
+        self.failures = failures
+        self.elapsed = elapsed
+
+    @property
+    def total_ops(self) -> int:
+        return sum(len(values) for values in self.latencies.values())
+
+    @property
+    def throughput(self) -> float:
+        return self.total_ops / self.elapsed if self.elapsed else 0.0
+
+    def percentiles(self, op: str) -> Dict[float, float]:
+        return {pct: percentile(self.latencies[op], pct) for pct in PERCENTILES}
+
+    def print_report(self, out=sys.stdout):
+        print(f"{self.total_ops} operations in {self.elapsed:.3f}s ({self.throughput:,.0f} ops/s)", file=out)
+        header = " ".join(f"{'p' + format(pct, 'g'):>9}" for pct in PERCENTILES)
+        print(f"{'Operation':<12} {'Count':>8} {'Failed':>7} {header}   (us)", file=out)
+        print("-" * (30 + 10 * len(PERCENTILES)), file=out)
+        for op in sorted(self.latencies):
+            values = " ".join(f"{v * 1e6:>9.1f}" for v in self.percentiles(op).values())
+            print(f"{op:<12} {len(self.latencies[op]):>8} {self.failures.get(op, 0):>7} {values}", file=out)
+
+
+class LoadGenerator:
+    """
+    Simulates concurrent shoppers, plus an admin editing prices in the background, against one ShoppingApp.
+
+    Args:
+        shop (ShoppingApp): The shop to load.
+        shoppers (int): The number of concurrent shopper threads.
+        operations (int): The number of operations each shopper performs.
+        zipf_s (float): The Zipf exponent for product popularity (default is 1.0).
+        mix (Dict[str, float]): Relative weights for "browse", "add", "remove" and "checkout".
+        admin_interval (Optional[float]): Seconds between admin price edits, or None to disable them.
+        seed (int): Seed for the shoppers' random generators.
+    """
+    def __init__(
+        self,
+        shop: ShoppingApp,
+        shoppers: int,
+        operations: int,
+        zipf_s: float = 1.0,
+        mix: Optional[Dict[str, float]] = None,
+        admin_interval: Optional[float] = 0.01,
+        seed: int = 0,
+    ):
+        self.shop = shop
+        self.shoppers = shoppers
+        self.operations = operations
+        self.zipf_s = zipf_s
+        self.mix = dict(mix or DEFAULT_MIX)
+        unknown = set(self.mix) - set(DEFAULT_MIX)
+        if unknown:
+            raise ValueError(f"Unknown operations in mix: {', '.join(sorted(unknown))}")
+        self.admin_interval = admin_interval
+        self.seed = seed
+        self._lock = threading.Lock()
+        self._latencies: Dict[str, List[float]] = {}
+        self._failures: Dict[str, int] = {}
+
+    def _record(self, latencies: Dict[str, List[float]], failures: Dict[str, int]):
+        with self._lock:
+            for op, values in latencies.items():
+                self._latencies.setdefault(op, []).extend(values)
+            for op, count in failures.items():
+                self._failures[op] = self._failures.get(op, 0) + count
+
+    def _timed(self, latencies, failures, op: str, func, *args):
+        start = time.perf_counter()
+        try:
+            ok = func(*args)
+        except Exception:
+            ok = False
+        latencies.setdefault(op, []).append(time.perf_counter() - start)
+        if ok is False:
+            failures[op] = failures.get(op, 0) + 1
+
+    def _shopper(self, index: int, product_ids: List[int]):
+        rng = random.Random(self.seed + index)
+        popularity = ZipfSampler(len(product_ids), self.zipf_s, rng)
+        ops = list(self.mix)
+        weights = [self.mix[op] for op in ops]
+        view = session_view(self.shop)
+        latencies: Dict[str, List[float]] = {}
+        failures: Dict[str, int] = {}
+
+        username = f"shopper{index}"
+        self._timed(latencies, failures, "login", view.login, username, "load")
+        for _ in range(self.operations):
+            op = rng.choices(ops, weights)[0]
+            if op == "browse":
+                self._timed(latencies, failures, op, view.display_catalog)
+            elif op == "add":
+                product_id = product_ids[popularity.sample()]
+                self._timed(latencies, failures, op, view.add_to_cart, product_id, rng.randint(1, 3))
+            elif op == "remove":
+                cart = view.get_cart()
+                if not cart or not cart.items:
+                    continue
+                product_id = rng.choice(list(cart.items))
+                self._timed(latencies, failures, op, view.remove_from_cart, product_id)
+            elif op == "checkout":
+                cart = view.get_cart()
+                if not cart or not cart.items:
+                    continue
+                self._timed(latencies, failures, op, view.checkout, rng.choice(list(PaymentMethod)))
+        view.logout()
+        self._record(latencies, failures)
+
+    def _admin(self, product_ids: List[int], stop: threading.Event):
+        rng = random.Random(self.seed - 1)
+        view = session_view(self.shop)
+        view.login("admin", "admin123")
+        latencies: Dict[str, List[float]] = {}
+        failures: Dict[str, int] = {}
+        while not stop.wait(self.admin_interval):
+            product = view.products.get(rng.choice(product_ids))
+            if product is None:
+                continue
+            price = round(product.price * rng.uniform(0.9, 1.1), 2)
+            self._timed(
+                latencies, failures, "admin_edit",
+                view.update_product, product.id, product.name, product.category_id, price,
+            )
+        view.logout()
+        self._record(latencies, failures)
+
+    def run(self) -> LoadReport:
+        """
+        Runs the shoppers to completion and returns the collected latencies.
+        """
+        for index in range(self.shoppers):
+            username = f"shopper{index}"
+            if username not in self.shop.users:
+                self.shop.users[username] = User(username, "load", UserType.user)
+        # Popularity rank follows the catalog's id order
+        product_ids = sorted(self.shop.products)
+
+        stop = threading.Event()
+        threads = [
+            threading.Thread(target=self._shopper, args=(index, product_ids), name=f"shopper-{index}")
+            for index in range(self.shoppers)
+        ]
+        admin = None
+        if self.admin_interval is not None:
+            admin = threading.Thread(target=self._admin, args=(product_ids, stop), name="admin")
+
+        # The app reports everything on stdout; keep it out of the measurements
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            if admin:
+                admin.start()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            elapsed = time.perf_counter() - start
+            stop.set()
+            if admin:
+                admin.join()
+        return LoadReport(self._latencies, self._failures, elapsed)
+
+
+def seed_catalog(shop: ShoppingApp, size: int):
+    """
+    Adds generated products to the shop until it holds at least `size` products.
+    """
+    current_user = shop.current_user
+    category_ids = sorted(shop.categories)
+    with contextlib.redirect_stdout(io.StringIO()):
+        shop.login("admin", "admin123")
+        for i in range(len(shop.products), size):
+            shop.add_product(f"Product {i}", category_ids[i % len(category_ids)], round(5 + (i % 200) * 1.25, 2))
+        shop.logout()
+    shop.current_user = current_user
+
+
+def parse_mix(value: str) -> Dict[str, float]:
+    mix = {}
+    for part in value.split(","):
+        op, _, weight = part.partition("=")
+        mix[op.strip()] = float(weight)
+    return mix
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Simulate concurrent shoppers against an in-process ShoppingApp.")
+    parser.add_argument("--shoppers", type=int, default=8, help="number of concurrent shoppers")
+    parser.add_argument("--ops", type=int, default=1000, help="operations per shopper")
+    parser.add_argument("--products", type=int, default=1000, help="catalog size")
+    parser.add_argument("--zipf", type=float, default=1.0, help="Zipf exponent for product popularity")
+    parser.add_argument("--mix", type=parse_mix, default=DEFAULT_MIX,
+                        help="operation weights, e.g. browse=50,add=30,remove=10,checkout=10")
+    parser.add_argument("--admin-interval", type=float, default=0.01,
+                        help="seconds between admin price edits (negative disables them)")
+    parser.add_argument("--admission", action="store_true", help="enable admission control on login and checkout")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    shop = ShoppingApp()
+    seed_catalog(shop, args.products)
+    if args.admission:
+        shop.admission = AdmissionController()
+    generator = LoadGenerator(
+        shop,
+        shoppers=args.shoppers,
+        operations=args.ops,
+        zipf_s=args.zipf,
+        mix=args.mix,
+        admin_interval=args.admin_interval if args.admin_interval >= 0 else None,
+        seed=args.seed,
+    )
+    generator.run().print_report()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
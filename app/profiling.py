@@ -0,0 +1,293 @@
+import cProfile
+import os
+import pstats
+import random
+import threading
+import tracemalloc
+from typing import Dict, List, Optional, TextIO, Tuple
+
+from .app import (
+    Cart,
+    CartItem,
+    CatalogViewCache,
+    Category,
+    IdempotencyCache,
+    Payment,
+    Product,
+    ShoppingApp,
+    User,
+)
+
+
+# ShoppingApp methods that can be profiled
+DEFAULT_OPERATIONS = (
+    "login",
+    "logout",
+    "add_to_cart",
+    "remove_from_cart",
+    "checkout",
+    "add_product",
+    "update_product",
+    "remove_product",
+    "add_category",
+    "remove_category",
+    "display_catalog",
+    "display_categories",
+    "query_catalog",
+    "recommend_for_cart",
+)
+
+
+# Class-level hooks shared by every attached profiler:
+# (class, op) -> [original function, attach count, whether the class defined op itself]
+_HOOKS: Dict[Tuple[type, str], list] = {}
+_HOOKS_LOCK = threading.Lock()
+
+
+def _dispatch(op: str, original):
+    # Runs the operation through the profiler attached to the instance it is
+    # called on, so copies of a profiled shop keep their own state
+    def hooked(self, *args, **kwargs):
+        profiler = self.__dict__.get("_profiler")
+        if profiler is None or profiler._shop is None or op not in profiler._roots:
+            return original(self, *args, **kwargs)
+        return profiler._sampled(op, original, self, *args, **kwargs)
+    hooked.__name__ = original.__name__
+    hooked.__qualname__ = original.__qualname__
+    hooked.__doc__ = original.__doc__
+    return hooked
+
+
+class OperationProfiler:
+    """
+    Profiles a sampled fraction of ShoppingApp operations with cProfile.
+
+    Nothing is installed until attach() is called. The hooks sit on the shop's
+    class and profile calls on the attached shop and on copies of it (such as
+    loadgen.session_view()), each running against its own state. Other shops
+    only pay an attribute lookup while some profiler is attached, and detach()
+    removes the hooks again once no profiler needs them.
+
+    Args:
+        sample_rate (float): The fraction of calls to profile, between 0 and 1 (default is 0.01).
+        operations (Tuple[str, ...]): The ShoppingApp methods to sample (default is DEFAULT_OPERATIONS).
+        seed (Optional[int]): Seed for the sampling decisions.
+
+    Methods:
+        attach(shop): Starts sampling the shop's operations.
+        detach(): Stops sampling and removes the hooks nobody else needs.
+        stats(op) -> Optional[pstats.Stats]: The merged profile of an operation's sampled calls.
+        collapsed_stacks() -> List[str]: Profiles as "op;frame;frame microseconds" lines for flamegraph tools.
+        write_collapsed(out): Writes collapsed_stacks() to a stream.
+    """
+    def __init__(self, sample_rate: float = 0.01, operations: Tuple[str, ...] = DEFAULT_OPERATIONS,
+                 seed: Optional[int] = None):
+        if not 0 <= sample_rate <= 1:
+            raise ValueError("Sample rate must be between 0 and 1")
+        self.sample_rate = sample_rate
+        self.operations = operations
+        self.calls: Dict[str, int] = {}
+        self.samples: Dict[str, int] = {}
+        self._stats: Dict[str, pstats.Stats] = {}
+        self._roots: Dict[str, tuple] = {}
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._shop: Optional[ShoppingApp] = None
+
+    def attach(self, shop: ShoppingApp):
+        if self._shop is not None:
+            raise ValueError("Profiler is already attached")
+        if shop.__dict__.get("_profiler") is not None:
+            raise ValueError("Shop already has a profiler attached")
+        cls = type(shop)
+        with _HOOKS_LOCK:
+            for op in self.operations:
+                hook = _HOOKS.get((cls, op))
+                if hook is None:
+                    original = getattr(cls, op)
+                    hook = _HOOKS[(cls, op)] = [original, 0, op in cls.__dict__]
+                    setattr(cls, op, _dispatch(op, original))
+                hook[1] += 1
+                code = hook[0].__code__
+                self._roots[op] = (code.co_filename, code.co_firstlineno, code.co_name)
+        self._shop = shop
+        shop._profiler = self
+
+    def detach(self):
+        if self._shop is None:
+            return
+        shop, self._shop = self._shop, None
+        shop.__dict__.pop("_profiler", None)
+        cls = type(shop)
+        with _HOOKS_LOCK:
+            for op in self.operations:
+                hook = _HOOKS[(cls, op)]
+                hook[1] -= 1
+                if not hook[1]:
+                    if hook[2]:
+                        setattr(cls, op, hook[0])
+                    else:
+                        delattr(cls, op)
+                    del _HOOKS[(cls, op)]
+
+    def _sampled(self, op: str, original, shop: ShoppingApp, *args, **kwargs):
+        with self._lock:
+            self.calls[op] = self.calls.get(op, 0) + 1
+            sample = self._rng.random() < self.sample_rate
+        # cProfile can't nest, so calls made inside a sampled call run plainly
+        if not sample or getattr(self._local, "active", False):
+            return original(shop, *args, **kwargs)
+        profile = cProfile.Profile()
+        self._local.active = True
+        try:
+            return profile.runcall(original, shop, *args, **kwargs)
+        finally:
+            self._local.active = False
+            self._record(op, profile)
+
+    def _record(self, op: str, profile: cProfile.Profile):
+        with self._lock:
+            self.samples[op] = self.samples.get(op, 0) + 1
+            if op in self._stats:
+                self._stats[op].add(profile)
+            else:
+                self._stats[op] = pstats.Stats(profile)
+
+    def stats(self, op: str) -> Optional[pstats.Stats]:
+        return self._stats.get(op)
+
+    @staticmethod
+    def _label(func: tuple) -> str:
+        filename, lineno, name = func
+        if filename == "~":
+            label = name
+        else:
+            label = f"{name} ({os.path.basename(filename)}:{lineno})"
+        return label.replace(";", ",").replace(" ", "_")
+
+    def _collapse(self, op: str, stats: pstats.Stats) -> List[str]:
+        # cProfile only records caller -> callee edges, so stacks are rebuilt
+        # from the root by splitting each function's time across its callers
+        table = stats.stats
+        children: Dict[tuple, List[Tuple[tuple, float]]] = {}
+        for callee, (_, _, _, _, callers) in table.items():
+            for caller, edge in callers.items():
+                children.setdefault(caller, []).append((callee, edge[3]))
+
+        lines: Dict[str, float] = {}
+
+        def walk(func: tuple, path: List[str], weight: float, seen: set):
+            _, _, tt, ct, _ = table[func]
+            stack = ";".join(path)
+            lines[stack] = lines.get(stack, 0.0) + tt * weight
+            if len(path) >= 64:
+                return
+            for callee, edge_ct in children.get(func, ()):
+                callee_ct = table[callee][3]
+                if callee in seen or not callee_ct:
+                    continue
+                child_weight = weight * edge_ct / callee_ct
+                if child_weight * callee_ct < 1e-7:
+                    continue
+                walk(callee, path + [self._label(callee)], child_weight, seen | {callee})
+
+        root = self._roots[op]
+        if root in table:
+            walk(root, [op], 1.0, {root})
+        return [f"{stack} {round(seconds * 1e6)}" for stack, seconds in lines.items() if round(seconds * 1e6) > 0]
+
+    def collapsed_stacks(self) -> List[str]:
+        with self._lock:
+            stats = dict(self._stats)
+        lines = []
+        for op in sorted(stats):
+            lines.extend(self._collapse(op, stats[op]))
+        return lines
+
+    def write_collapsed(self, out: TextIO):
+        for line in self.collapsed_stacks():
+            out.write(line + "\n")
+
+
+def _code_ranges(*funcs) -> List[Tuple[str, int, int]]:
+    ranges = []
+    for func in funcs:
+        code = func.__code__
+        lines = [line for _, _, line in code.co_lines() if line is not None]
+        ranges.append((code.co_filename, code.co_firstlineno, max(lines, default=code.co_firstlineno)))
+    return ranges
+
+
+# Memory is attributed to the first of these areas found in an allocation's
+# traceback, innermost frame first.
+MEMORY_AREAS = {
+    "carts": _code_ranges(
+        Cart.__init__, Cart.add_item, Cart.update_item, CartItem.__init__,
+        ShoppingApp.add_to_cart,
+    ),
+    "sessions": _code_ranges(User.login, ShoppingApp._login),
+    "catalog": _code_ranges(
+        Product.__init__, Category.__init__, CatalogViewCache.put,
+        ShoppingApp.add_product, ShoppingApp.update_product, ShoppingApp.add_category,
+        ShoppingApp._catalog_view, ShoppingApp._sorted_index, ShoppingApp.display_categories,
+    ),
+    "payments": _code_ranges(Payment.__init__, ShoppingApp._checkout, IdempotencyCache.run),
+}
+
+
+class MemoryAccounting:
+    """
+    Attributes memory allocated while tracing to carts, sessions, catalog and payments.
+
+    Only allocations made after start() are seen. Tracing slows every allocation
+    down, so it should only be switched on while investigating.
+
+    Args:
+        nframes (int): The number of frames kept per allocation (default is 25).
+
+    Methods:
+        start(): Starts tracing allocations.
+        stop(): Stops tracing and discards the traces.
+        snapshot() -> Dict[str, int]: Bytes currently allocated per area, plus "other".
+    """
+    def __init__(self, nframes: int = 25):
+        self.nframes = nframes
+
+    def start(self):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.nframes)
+
+    def stop(self):
+        tracemalloc.stop()
+
+    @staticmethod
+    def _area(traceback: tracemalloc.Traceback, cache: Dict[Tuple[str, int], Optional[str]]) -> str:
+        for frame in reversed(traceback):
+            key = (frame.filename, frame.lineno)
+            if key not in cache:
+                cache[key] = next(
+                    (
+                        area
+                        for area, ranges in MEMORY_AREAS.items()
+                        for filename, first, last in ranges
+                        if frame.filename == filename and first <= frame.lineno <= last
+                    ),
+                    None,
+                )
+            if cache[key] is not None:
+                return cache[key]
+        return "other"
+
+    def snapshot(self) -> Dict[str, int]:
+        if not tracemalloc.is_tracing():
+            raise RuntimeError("Memory accounting is not started")
+        snapshot = tracemalloc.take_snapshot().filter_traces(
+            [tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, __file__)]
+        )
+        totals = {area: 0 for area in MEMORY_AREAS}
+        totals["other"] = 0
+        frames: Dict[Tuple[str, int], Optional[str]] = {}
+        for stat in snapshot.statistics("traceback"):
+            totals[self._area(stat.traceback, frames)] += stat.size
+        return totals
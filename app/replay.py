@@ -0,0 +1,275 @@
+import argparse
+import contextlib
+import io
+import json
+import sys
+import time
+from typing import Dict, Iterable, Iterator, List, Optional, TextIO
+
+from .app import PaymentMethod, ShoppingApp, main as interactive_main
+
+
+# Operations that can appear in a trace, mapped to the ordered argument
+# names of the matching ShoppingApp method.
+OPERATIONS: Dict[str, List[str]] = {
+    "login": ["username", "password"],
+    "logout": [],
+    "add_to_cart": ["product_id", "quantity"],
+    "remove_from_cart": ["product_id"],
+    "checkout": ["payment_method", "idempotency_key"],
+    "add_product": ["name", "category_id", "price"],
+    "update_product": ["product_id", "name", "category_id", "price"],
+    "remove_product": ["product_id"],
+    "add_category": ["name", "parent_id"],
+    "remove_category": ["category_id", "subtree"],
+    "display_catalog": [],
+    "display_categories": [],
+}
+
+# Trailing arguments that may be left out of a record
+OPTIONAL_ARGUMENTS = {"idempotency_key", "parent_id", "subtree"}
+
+# The JSON types each argument may have in a record
+ARGUMENT_TYPES: Dict[str, tuple] = {
+    "username": (str,),
+    "password": (str,),
+    "product_id": (int,),
+    "quantity": (int,),
+    "payment_method": (str,),
+    "idempotency_key": (str, int),
+    "name": (str,),
+    "category_id": (int,),
+    "price": (int, float),
+    "parent_id": (int, type(None)),
+    "subtree": (bool,),
+}
+
+
+class OpResult:
+    """
+    OpResult class.
+
+    Attributes:
+        line (int): The 1-based position of the operation in the trace.
+        op (str): The name of the operation.
+        ok (bool): The value returned by the ShoppingApp method (True for display operations).
+        elapsed (float): The wall-clock time spent in the operation, in seconds.
+    """
+    def __init__(self, line: int, op: str, ok: bool, elapsed: float):
+        self.line = line
+        self.op = op
+        self.ok = ok
+        self.elapsed = elapsed
+
+
+class TraceError(ValueError):
+    """
+    Raised when a trace record is malformed or names an unknown operation.
+    """
+
+
+def parse_payment_method(value: str) -> PaymentMethod:
+    """
+    Resolves a payment method from either its name ("CREDIT_CARD") or its value ("Credit Card").
+
+    Args:
+        value (str): The recorded payment method.
+
+    Returns:
+        PaymentMethod: The matching payment method.
+    """
+    if value in PaymentMethod.__members__:
+        return PaymentMethod[value]
+    return PaymentMethod(value)
+
+
+def load_trace(stream: TextIO) -> Iterator[dict]:
+    """
+    Reads trace records from a JSONL stream. Blank lines and lines starting with "#" are skipped.
+
+    Args:
+        stream (TextIO): The stream to read from.
+
+    Returns:
+        Iterator[dict]: The decoded records, in order.
+    """
+    for number, line in enumerate(stream, 1):
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        try:
+            record = json.loads(line)
+        except json.JSONDecodeError as e:
+            raise TraceError(f"line {number}: {e}") from e
+        if not isinstance(record, dict) or record.get("op") not in OPERATIONS:
+            raise TraceError(f"line {number}: unknown operation {record!r}")
+        yield record
+
+
+def apply_record(shop: ShoppingApp, record: dict) -> bool:
+    """
+    Applies a single trace record to the shop.
+
+    Args:
+        shop (ShoppingApp): The shop to drive.
+        record (dict): A record such as {"op": "add_to_cart", "args": {"product_id": 1, "quantity": 2}}.
+
+    Returns:
+        bool: The result of the operation (True for display operations).
+    """
+    if not isinstance(record, dict) or record.get("op") not in OPERATIONS:
+        raise TraceError(f"unknown operation {record!r}")
+    op = record["op"]
+    args = record.get("args", {})
+    if not isinstance(args, dict):
+        raise TraceError(f"{op}: args must be an object, not {args!r}")
+    unknown = set(args) - set(OPERATIONS[op])
+    if unknown:
+        raise TraceError(f"{op}: unknown arguments {', '.join(sorted(unknown))}")
+    names = list(OPERATIONS[op])
+    while names and names[-1] in OPTIONAL_ARGUMENTS and names[-1] not in args:
+        names.pop()
+    try:
+        values = [args[name] for name in names]
+    except KeyError as e:
+        raise TraceError(f"{op}: missing argument {e}") from e
+    for name, value in zip(names, values):
+        types = ARGUMENT_TYPES[name]
+        # JSON true/false decode to bool, which Python also counts as an int
+        if not isinstance(value, types) or (isinstance(value, bool) and bool not in types):
+            raise TraceError(f"{op}: {name} has the wrong type: {value!r}")
+    if op == "checkout":
+        try:
+            values[0] = parse_payment_method(values[0])
+        except (TypeError, ValueError) as e:
+            raise TraceError(f"{op}: unknown payment method {values[0]!r}") from e
+    result = getattr(shop, op)(*values)
+    return True if result is None else bool(result)
+
+
+def replay(shop: ShoppingApp, records: Iterable[dict], quiet: bool = True) -> List[OpResult]:
+    """
+    Replays trace records against the shop without prompting.
+
+    Args:
+        shop (ShoppingApp): The shop to drive.
+        records (Iterable[dict]): The records to apply, in order.
+        quiet (bool): Discard the shop's console output while replaying (default is True).
+
+    Returns:
+        List[OpResult]: One result per applied record.
+    """
+    results: List[OpResult] = []
+    sink = io.StringIO() if quiet else None
+    with contextlib.redirect_stdout(sink) if quiet else contextlib.nullcontext():
+        for line, record in enumerate(records, 1):
+            start = time.perf_counter()
+            try:
+                ok = apply_record(shop, record)
+            except TraceError as e:
+                raise TraceError(f"line {line}: {e}") from e
+            results.append(OpResult(line, record["op"], ok, time.perf_counter() - start))
+            if sink is not None:
+                # Don't let a long trace accumulate output we're throwing away
+                sink.seek(0)
+                sink.truncate()
+    return results
+
+
+def summarize(results: List[OpResult]) -> Dict[str, Dict[str, float]]:
+    """
+    Aggregates per-operation timings.
+
+    Args:
+        results (List[OpResult]): The results returned by replay().
+
+    Returns:
+        Dict[str, Dict[str, float]]: For each operation the count, failures, total, mean and max time in seconds.
+    """
+    summary: Dict[str, Dict[str, float]] = {}
+    for result in results:
+        stats = summary.setdefault(result.op, {"count": 0, "failed": 0, "total": 0.0, "max": 0.0})
+        stats["count"] += 1
+        stats["failed"] += 0 if result.ok else 1
+        stats["total"] += result.elapsed
+        stats["max"] = max(stats["max"], result.elapsed)
+    for stats in summary.values():
+        stats["mean"] = stats["total"] / stats["count"]
+    return summary
+
+
+def print_summary(summary: Dict[str, Dict[str, float]], out: TextIO = sys.stdout):
+    """
+    Prints the per-operation timing table produced by summarize().
+    """
+    print(f"{'Operation':<20} {'Count':>7} {'Failed':>7} {'Total ms':>10} {'Mean us':>10} {'Max us':>10}", file=out)
+    print("-" * 69, file=out)
+    for op, stats in sorted(summary.items()):
+        print(
+            f"{op:<20} {stats['count']:>7} {stats['failed']:>7} {stats['total'] * 1e3:>10.3f} "
+            f"{stats['mean'] * 1e6:>10.1f} {stats['max'] * 1e6:>10.1f}",
+            file=out,
+        )
+
+
+class RecordingShop:
+    """
+    Wraps a ShoppingApp and appends every traced operation to a JSONL stream.
+
+    Any attribute that is not a traced operation is forwarded to the wrapped shop,
+    so the wrapper can be handed to main() in place of a ShoppingApp.
+
+    Args:
+        shop (ShoppingApp): The shop to wrap.
+        out (TextIO): The stream the trace is written to.
+    """
+    def __init__(self, shop: ShoppingApp, out: TextIO):
+        self._shop = shop
+        self._out = out
+
+    def __getattr__(self, name: str):
+        attr = getattr(self._shop, name)
+        if name not in OPERATIONS:
+            return attr
+
+        def recorded(*args, **kwargs):
+            values = dict(zip(OPERATIONS[name], args))
+            values.update(kwargs)
+            if name == "checkout":
+                values["payment_method"] = values["payment_method"].name
+            record = {"op": name, "args": values}
+            self._out.write(json.dumps(record) + "\n")
+            self._out.flush()
+            return attr(*args, **kwargs)
+        return recorded
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Replay or record ShoppingApp traces.")
+    parser.add_argument("trace", nargs="?", help="JSONL trace to replay ('-' for stdin)")
+    parser.add_argument("--record", metavar="PATH", help="run the interactive app and record the session to PATH")
+    parser.add_argument("--verbose", action="store_true", help="show the app's output while replaying")
+    args = parser.parse_args(argv)
+
+    if args.record:
+        with open(args.record, "a", encoding="utf-8") as out:
+            interactive_main(RecordingShop(ShoppingApp(), out))
+        return 0
+    if not args.trace:
+        parser.error("a trace file is required unless --record is given")
+
+    stream = sys.stdin if args.trace == "-" else open(args.trace, encoding="utf-8")
+    try:
+        results = replay(ShoppingApp(), load_trace(stream), quiet=not args.verbose)
+    except TraceError as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 1
+    finally:
+        if stream is not sys.stdin:
+            stream.close()
+    print_summary(summarize(results))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
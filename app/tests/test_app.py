@@ -1,3 +1,11 @@
+import base64
+import contextlib
+import io
+import itertools
+import json
+import sqlite3
+import threading
+import time
 import pytest
 from datetime import datetime
 from ..app import (
@@ -11,8 +19,20 @@ from ..app import (
     Cart,
     PaymentMethod,
     Payment,
-    ShoppingApp
+    ShoppingApp,
+    CoOccurrenceModel,
+    AdmissionController,
+    AdmissionRejected,
+    ConcurrencyGate,
+    IdempotencyCache,
+    EventType,
+    EventBus,
+    IdAllocator,
+    JobQueue,
+    FulfilmentWorkers,
+    SessionTokenSigner,
 )
+from ..loadgen import session_view
 
 # Test data
 USERNAME = "test_user"
@@ -326,7 +346,7 @@ def test_cart_operations(shopping_app):
     
     # Test adding valid product
     assert shopping_app.add_to_cart(1, 2)
-    cart = shopping_app.carts[shopping_app.current_user.session_id]
+    cart = shopping_app.carts[shopping_app.current_user.username]
     assert cart.items[1].quantity == 2
     
     # Test adding invalid product
@@ -342,7 +362,7 @@ def test_cart_operations(shopping_app):
     shopping_app.login("user1", "pass123")
     shopping_app.add_to_cart(1, 2)
     assert shopping_app.remove_from_cart(1)
-    cart = shopping_app.carts[shopping_app.current_user.session_id]
+    cart = shopping_app.carts[shopping_app.current_user.username]
     assert 1 not in cart.items
     
     # Test removing non-existent product
@@ -358,7 +378,7 @@ def test_checkout(shopping_app):
     
     # Test successful checkout
     assert shopping_app.checkout(PaymentMethod.CREDIT_CARD)
-    cart = shopping_app.carts[shopping_app.current_user.session_id]
+    cart = shopping_app.carts[shopping_app.current_user.username]
     assert len(cart.items) == 0
     
     # Test checkout with empty cart
@@ -366,4 +386,725 @@ def test_checkout(shopping_app):
     
     # Test checkout without login
     shopping_app.logout()
-    assert not shopping_app.checkout(PaymentMethod.CREDIT_CARD)
\ No newline at end of file
+    assert not shopping_app.checkout(PaymentMethod.CREDIT_CARD)
+
+def test_catalog_view_cache(shopping_app, capsys):
+    """Test that catalog listings are cached until the catalog changes"""
+    shopping_app.display_catalog()
+    first = capsys.readouterr().out
+    assert "Leather Boots" in first
+    version = shopping_app.catalog_version
+    rows = shopping_app.get_catalog_rows()
+    assert rows[0] == (1, "Leather Boots", "Boots", 199.99)
+    assert shopping_app.get_catalog_rows() is rows
+
+    # Per-category listing
+    assert shopping_app.get_catalog_rows(2) == [(2, "Winter Coat", "Coats", 249.99)]
+
+    # A no-op update keeps the cached listing
+    shopping_app.login("admin", "admin123")
+    assert shopping_app.update_product(1, "Leather Boots", 1, 199.99)
+    assert shopping_app.catalog_version == version
+    assert shopping_app.get_catalog_rows() is rows
+
+    # A real change invalidates it
+    assert shopping_app.update_product(1, "Leather Boots", 1, 149.99)
+    assert shopping_app.catalog_version == version + 1
+    assert shopping_app.get_catalog_rows()[0] == (1, "Leather Boots", "Boots", 149.99)
+
+    assert shopping_app.add_category("Scarves")
+    capsys.readouterr()
+    shopping_app.display_categories()
+    assert "Scarves" in capsys.readouterr().out
+
+
+def test_catalog_pagination(shopping_app):
+    """Test keyset pagination and streaming export of the catalog"""
+    shopping_app.login("admin", "admin123")
+    for i in range(10):
+        shopping_app.add_product(f"Scarf {i}", 4, 10.0 + i)
+
+    # Walk all pages by id
+    seen, cursor = [], None
+    while True:
+        page = shopping_app.query_catalog(page_size=4, cursor=cursor)
+        seen.extend(row[0] for row in page.items)
+        cursor = page.next_cursor
+        if cursor is None:
+            break
+    assert seen == sorted(shopping_app.products)
+
+    # Sort by price within a category; a cursor survives catalog changes
+    page = shopping_app.query_catalog(page_size=3, sort="price", category_id=4)
+    assert [row[3] for row in page.items] == [10.0, 11.0, 12.0]
+    shopping_app.remove_product(5)  # the 10.0 scarf
+    page = shopping_app.query_catalog(page_size=3, cursor=page.next_cursor, sort="price", category_id=4)
+    assert [row[3] for row in page.items] == [13.0, 14.0, 15.0]
+
+    # Cursors are tied to the query that produced them
+    with pytest.raises(ValueError):
+        shopping_app.query_catalog(cursor=page.next_cursor, sort="name")
+    with pytest.raises(ValueError):
+        shopping_app.query_catalog(cursor="not-a-cursor")
+    # A well-formed cursor whose key has the wrong types is rejected too
+    forged = base64.urlsafe_b64encode(json.dumps(["catalog", "name", None, [1, "x"]]).encode()).decode()
+    with pytest.raises(ValueError, match="Invalid cursor"):
+        shopping_app.query_catalog(cursor=forged, sort="name")
+
+    page = shopping_app.query_categories(page_size=2, sort="name")
+    assert [row[1] for row in page.items] == ["Boots", "Caps"]
+
+    out = io.StringIO()
+    assert shopping_app.export_catalog(out, sort="name") == len(shopping_app.products)
+    first = json.loads(out.getvalue().splitlines()[0])
+    assert first["name"] == "Denim Jacket"
+
+
+def test_export_catalog_while_changing(shopping_app):
+    """Test that an export sorts once and stays a snapshot while the catalog changes"""
+    shopping_app.login("admin", "admin123")
+    for i in range(20):
+        shopping_app.add_product(f"Scarf {i:02}", 4, 10.0 + i)
+    expected = [row[0] for row in sorted(shopping_app.get_catalog_rows(), key=lambda row: (row[1], row[0]))]
+
+    sorts = []
+    build = shopping_app._sorted_index
+    shopping_app._sorted_index = lambda *args: sorts.append(args) or build(*args)
+
+    class EditingStream(io.StringIO):
+        # Edits a price for every product written, like an admin working during the export
+        def write(self, text):
+            product = shopping_app.products[5]
+            shopping_app.update_product(5, product.name, product.category_id, product.price + 1)
+            return super().write(text)
+
+    out = EditingStream()
+    with contextlib.redirect_stdout(io.StringIO()):
+        assert shopping_app.export_catalog(out, sort="name", page_size=3) == 24
+    assert [json.loads(line)["id"] for line in out.getvalue().splitlines()] == expected
+    assert len(sorts) == 1
+
+
+def test_recommend_for_cart(shopping_app):
+    """Test that checkouts feed the frequently-bought-together model"""
+    shopping_app.login("user1", "pass123")
+    assert shopping_app.recommend_for_cart() == []
+    for basket in ([1, 4], [1, 4], [1, 2], [3]):
+        for product_id in basket:
+            shopping_app.add_to_cart(product_id, 1)
+        assert shopping_app.checkout(PaymentMethod.UPI)
+
+    shopping_app.add_to_cart(1, 1)
+    recommended = shopping_app.recommend_for_cart()
+    assert [p.id for p in recommended] == [4, 2]
+    assert [p.id for p in shopping_app.recommend_for_cart(n=1)] == [4]
+
+
+def test_co_occurrence_pruning():
+    """Test that each product keeps at most K neighbours"""
+    model = CoOccurrenceModel(max_neighbors=3)
+    for other in range(2, 20):
+        model.record_basket([1, other])
+    model.record_basket([1, 3])
+    assert len(model.neighbors[1]) == 3
+    assert model.neighbors[1][0] == (3, 2)
+    assert len(model._counts[1]) <= 6
+    assert model.recommend([1], 1) == [3]
+
+
+def test_admission_control(shopping_app):
+    """Test token buckets and concurrency limits on login and checkout"""
+    now = [0.0]
+    shopping_app.admission = AdmissionController(
+        global_rate=100, global_burst=100, user_rate=1, user_burst=2, clock=lambda: now[0]
+    )
+    # Per-user burst of 2, then shed with a retry hint
+    assert shopping_app.login("user1", "pass123")
+    assert shopping_app.login("user1", "pass123")
+    assert not shopping_app.login("user1", "pass123")
+    assert shopping_app.retry_after == pytest.approx(1.0)
+    # Other users are unaffected, and the bucket refills over time
+    assert shopping_app.login("admin", "admin123")
+    now[0] += 1.0
+    assert shopping_app.login("user1", "pass123")
+    assert shopping_app.admission.rejected == {"login": 1}
+
+    # Catalog reads are never shed
+    for _ in range(10):
+        shopping_app.display_catalog()
+
+    # A full checkout gate with no queue rejects immediately
+    gate = ConcurrencyGate(max_active=1, max_waiting=0)
+    gate.acquire(timeout=0)
+    with pytest.raises(AdmissionRejected) as rejected:
+        gate.acquire(timeout=0)
+    # No call has finished yet, but the hint still spaces the retries out
+    assert rejected.value.retry_after == pytest.approx(gate.min_retry_after)
+    gate.release(0.01)
+    gate.acquire(timeout=0)
+
+
+def test_admission_gate_rejection_refunds_tokens():
+    """Test that a request shed by the concurrency gate doesn't use up the user's tokens"""
+    admission = AdmissionController(
+        user_rate=1, user_burst=2, limits={"checkout": (1, 0)}, clock=lambda: 0.0
+    )
+    with admission.admit("checkout", "user1"):
+        for _ in range(5):
+            with pytest.raises(AdmissionRejected, match="Too many requests in progress"):
+                with admission.admit("checkout", "user2"):
+                    pass
+    # user2 was shed five times but still has its whole burst
+    with admission.admit("checkout", "user2"):
+        pass
+    with admission.admit("checkout", "user2"):
+        pass
+    with pytest.raises(AdmissionRejected, match="Too many requests for this user"):
+        with admission.admit("checkout", "user2"):
+            pass
+    assert admission.rejected == {"checkout": 6}
+
+
+def test_idempotent_checkout(shopping_app):
+    """Test that retried checkouts with the same key are only charged once"""
+    shopping_app.login("user1", "pass123")
+    shopping_app.add_to_cart(1, 1)
+    assert shopping_app.checkout(PaymentMethod.UPI, idempotency_key="order-1")
+    # The retry replays the stored result without paying or touching the cart
+    shopping_app.add_to_cart(2, 1)
+    assert shopping_app.checkout(PaymentMethod.UPI, idempotency_key="order-1")
+    assert len(shopping_app.payments) == 1
+    assert 2 in shopping_app.get_cart().items
+    # A new key is a new order
+    assert shopping_app.checkout(PaymentMethod.UPI, idempotency_key="order-2")
+    assert len(shopping_app.payments) == 2
+    # Failures are not stored, so the key can be retried
+    assert not shopping_app.checkout(PaymentMethod.UPI, idempotency_key="order-3")
+    shopping_app.add_to_cart(3, 1)
+    assert shopping_app.checkout(PaymentMethod.UPI, idempotency_key="order-3")
+    assert len(shopping_app.payments) == 3
+
+
+def test_idempotency_cache_coalesces_and_expires():
+    """Test in-flight coalescing, TTL expiry and the size bound"""
+    now = [0.0]
+    cache = IdempotencyCache(max_entries=2, ttl=10, clock=lambda: now[0])
+    started, release = threading.Event(), threading.Event()
+    calls = []
+
+    def slow():
+        calls.append(1)
+        started.set()
+        release.wait()
+        return "paid"
+
+    results = []
+    leader = threading.Thread(target=lambda: results.append(cache.run("k", slow)))
+    leader.start()
+    started.wait()
+    follower = threading.Thread(target=lambda: results.append(cache.run("k", slow)))
+    follower.start()
+    release.set()
+    leader.join()
+    follower.join()
+    assert len(calls) == 1
+    assert sorted(results) == [("paid", False), ("paid", True)]
+
+    assert cache.run("k", lambda: "again") == ("paid", True)
+    now[0] += 11
+    assert cache.run("k", lambda: "again") == ("again", False)
+    cache.run("a", lambda: 1)
+    cache.run("b", lambda: 2)
+    assert cache.run("k", lambda: "third") == ("third", False)
+
+
+def test_event_bus(shopping_app):
+    """Test that catalog and cart mutations are published in order"""
+    events = []
+    shopping_app.events.subscribe(events.append)
+    batches = []
+    subscription = shopping_app.events.subscribe_batches(batches.append, max_batch=3, max_pending=2)
+
+    shopping_app.login("admin", "admin123")
+    shopping_app.add_category("Scarves")
+    shopping_app.add_product("Silk Scarf", 5, 39.99)
+    shopping_app.update_product(5, "Silk Scarf", 5, 39.99)  # no change, no event
+    shopping_app.update_product(5, "Silk Scarf", 5, 29.99)
+    shopping_app.remove_product(5)
+    shopping_app.remove_category(5)
+    shopping_app.logout()
+    shopping_app.login("user1", "pass123")
+    shopping_app.add_to_cart(1, 2)
+    shopping_app.get_cart().update_item(1, 3)
+    shopping_app.checkout(PaymentMethod.UPI)
+
+    assert [e.type for e in events] == [
+        EventType.CATEGORY_ADDED,
+        EventType.PRODUCT_ADDED,
+        EventType.PRODUCT_UPDATED,
+        EventType.PRODUCT_REMOVED,
+        EventType.CATEGORY_REMOVED,
+        EventType.CART_ITEM_ADDED,
+        EventType.CART_ITEM_UPDATED,
+        EventType.CART_CLEARED,
+    ]
+    assert [e.seq for e in events] == list(range(1, 9))
+    assert events[2].data == {"name": "Silk Scarf", "category_id": 5, "price": 29.99}
+    assert events[6].entity_id == shopping_app.current_user.username
+    assert events[6].data == {"product_id": 1, "quantity": 3}
+
+    subscription.flush()
+    assert all(len(batch) <= 3 for batch in batches)
+    assert [e.seq for batch in batches for e in batch] == list(range(1, 9))
+    shopping_app.events.unsubscribe(subscription)
+    shopping_app.logout()
+    shopping_app.login("admin", "admin123")
+    shopping_app.add_category("Gloves")
+    assert len(events) == 9
+    assert sum(len(batch) for batch in batches) == 8
+
+
+def test_catalog_changes_since_concurrent_writers(shopping_app):
+    """Test that a client syncing while several admins edit prices ends up with the shop's catalog"""
+    shopping_app.login("admin", "admin123")
+    client, synced = {}, 0
+    stop = threading.Event()
+
+    def admin(index):
+        view = session_view(shopping_app)
+        view.current_user = shopping_app.users["admin"]
+        for i in range(100):
+            product = view.products[1 + (index + i) % 4]
+            view.update_product(product.id, product.name, product.category_id, round(product.price + 0.01, 2))
+            time.sleep(0.0001)  # let the syncing client in between edits
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        threads = [threading.Thread(target=admin, args=(i,)) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        deltas = 0
+        while not stop.is_set():
+            # One more sync after the last writer has finished
+            if not any(thread.is_alive() for thread in threads):
+                stop.set()
+            delta = shopping_app.catalog_changes_since(synced)
+            if delta["full"]:
+                client = {}
+            else:
+                deltas += 1
+            client.update({p["id"]: p for p in delta["products"]["upserts"]})
+            synced = delta["version"]
+        for thread in threads:
+            thread.join()
+    assert deltas > 0
+
+    assert synced == shopping_app.catalog_version == 400
+    assert client == {pid: shopping_app._catalog_record("products", p) for pid, p in shopping_app.products.items()}
+    versions = [version for version, _ in shopping_app.catalog_log._entries.values()]
+    assert versions == sorted(versions)
+
+
+def test_id_allocator_blocks(tmp_path):
+    """Test leased id blocks across threads and allocator instances"""
+    allocator = IdAllocator(block_size=10, start={"product": 5})
+    assert allocator.peek("product") == 5
+    assert allocator.next_id("product") == 5
+    assert allocator.next_ids("product", 3) == [6, 7, 8]
+    assert allocator.next_ids("product", 25) == list(range(15, 40))
+    assert allocator.next_id("order") == 1
+
+    ids, lock = [], threading.Lock()
+
+    def worker():
+        mine = [allocator.next_id("category") for _ in range(50)]
+        with lock:
+            ids.extend(mine)
+
+    threads = [threading.Thread(target=worker) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(set(ids)) == 200
+
+    # Two allocators on one SQLite file behave like two worker processes,
+    # and the counter survives a restart
+    path = str(tmp_path / "ids.sqlite")
+    first = IdAllocator(path, block_size=100, start={"order": 1})
+    second = IdAllocator(path, block_size=100)
+    assert first.next_id("order") == 1
+    assert second.next_id("order") == 101
+    assert first.next_id("order") == 2
+    assert IdAllocator(path, block_size=100).next_id("order") == 201
+
+
+def test_shopping_app_uses_id_allocator(tmp_path):
+    """Test that products, categories and orders draw ids from the allocator"""
+    shop = ShoppingApp(IdAllocator(str(tmp_path / "ids.sqlite"), start={"product": 5, "category": 5}))
+    assert shop.next_product_id == 5
+    shop.login("admin", "admin123")
+    assert shop.add_category("Scarves")
+    assert shop.add_product("Silk Scarf", 5, 39.99)
+    assert shop.products[5].category_id == 5
+    assert shop.next_product_id == 6
+    shop.logout()
+    shop.login("user1", "pass123")
+    shop.add_to_cart(5, 1)
+    shop.checkout(PaymentMethod.UPI)
+    assert shop.payments[0].order_id == 1
+
+
+def test_job_queue_redelivery(tmp_path):
+    """Test batched dequeue, acknowledgement and visibility timeouts"""
+    now = [1000.0]
+    jobs = JobQueue(str(tmp_path / "jobs.sqlite"), visibility_timeout=30, clock=lambda: now[0])
+    for i in range(5):
+        jobs.enqueue({"n": i})
+    batch = jobs.dequeue(3)
+    assert [job.payload["n"] for job in batch] == [0, 1, 2]
+    assert [job.payload["n"] for job in jobs.dequeue(10)] == [3, 4]
+    assert jobs.dequeue(10) == []
+    jobs.ack([batch[0].id])
+    # Unacknowledged jobs come back once their visibility timeout passes
+    now[0] += 31
+    redelivered = jobs.dequeue(10)
+    assert [job.payload["n"] for job in redelivered] == [1, 2, 3, 4]
+    assert redelivered[0].attempts == 2
+    # The queue survives reopening
+    assert JobQueue(str(tmp_path / "jobs.sqlite")).pending() == 4
+
+
+def test_checkout_enqueues_fulfilment(shopping_app, tmp_path):
+    """Test that checkout hands orders to the fulfilment workers"""
+    shopping_app.order_queue = JobQueue(str(tmp_path / "orders.sqlite"))
+    fulfilled, attempts = [], []
+
+    def handler(order):
+        attempts.append(order["order_id"])
+        if len(attempts) == 1:
+            raise RuntimeError("mail server down")
+        fulfilled.append(order)
+
+    workers = FulfilmentWorkers(shopping_app.order_queue, handler, workers=2, poll_interval=0.01, retry_delay=0)
+    workers.start()
+    try:
+        shopping_app.login("user1", "pass123")
+        shopping_app.add_to_cart(1, 2)
+        assert shopping_app.checkout(PaymentMethod.UPI)
+        assert workers.drain(timeout=5)
+    finally:
+        workers.stop()
+    assert len(fulfilled) == 1
+    assert fulfilled[0]["items"] == [{"product_id": 1, "quantity": 2, "price": 199.99}]
+    assert fulfilled[0]["username"] == "user1"
+    assert workers.failed == 1
+
+
+def test_catalog_changes_since(shopping_app):
+    """Test delta catalog sync with a compacted change log"""
+    # A new client gets the seeded catalog as a full snapshot
+    snapshot = shopping_app.catalog_changes_since(0)
+    assert snapshot["full"]
+    assert snapshot["version"] == 0
+    assert [p["id"] for p in snapshot["products"]["upserts"]] == [1, 2, 3, 4]
+    assert snapshot["categories"]["upserts"][0] == {"id": 1, "name": "Boots", "parent_id": None}
+
+    shopping_app.login("admin", "admin123")
+    shopping_app.add_category("Scarves")
+    shopping_app.add_product("Silk Scarf", 5, 39.99)
+    synced = shopping_app.catalog_version
+    shopping_app.update_product(5, "Silk Scarf", 5, 29.99)
+    shopping_app.update_product(5, "Silk Scarf", 5, 24.99)
+    shopping_app.remove_product(1)
+    # Still a full snapshot after changes, so the seeded rows aren't lost
+    snapshot = shopping_app.catalog_changes_since(0)
+    assert snapshot["full"]
+    assert len(snapshot["categories"]["upserts"]) == 5
+
+    delta = shopping_app.catalog_changes_since(synced)
+    assert delta["version"] == synced + 3
+    assert delta["products"] == {
+        "upserts": [{"id": 5, "name": "Silk Scarf", "category_id": 5, "price": 24.99}],
+        "deletes": [1],
+    }
+    assert delta["categories"] == {"upserts": [], "deletes": []}
+    assert shopping_app.catalog_changes_since(delta["version"])["products"]["upserts"] == []
+
+    # Clients older than the retained log get a full snapshot
+    shopping_app.catalog_log.max_entries = 1
+    shopping_app.add_category("Gloves")
+    delta = shopping_app.catalog_changes_since(synced)
+    assert delta["full"]
+    assert len(delta["products"]["upserts"]) == len(shopping_app.products)
+    assert shopping_app.catalog_changes_since(delta["version"] + 5)["full"]
+
+
+def test_session_tokens(shopping_app):
+    """Test signed session tokens verified without the session's process state"""
+    now = [1000.0]
+    signer = SessionTokenSigner({"k1": b"secret-1"}, ttl=60, clock=lambda: now[0])
+    shopping_app.tokens = signer
+    shopping_app.login("user1", "pass123")
+    token = shopping_app.session_token
+    shopping_app.logout()
+    assert shopping_app.session_token is None
+
+    # Another worker sharing the keys accepts the token without the login
+    worker = ShoppingApp(tokens=SessionTokenSigner({"k1": b"secret-1"}, clock=lambda: now[0]))
+    assert worker.check_user_privileges(token)
+    assert not worker.check_admin_privileges(token)
+    claims = worker.tokens.verify(token)
+    assert claims.username == "user1"
+    assert claims.user_type == UserType.user
+
+    # Tampering, unknown keys and expiry are rejected
+    key_id, body, signature = token.split(".")
+    assert not worker.check_user_privileges(f"{key_id}.{body}x.{signature}")
+    assert not worker.check_user_privileges("garbage")
+    assert not ShoppingApp().check_user_privileges(token)
+
+    # Rotation keeps old tokens valid until the old key is retired
+    signer.rotate("k2", b"secret-2")
+    shopping_app.login("admin", "admin123")
+    admin_token = shopping_app.session_token
+    assert admin_token.startswith("k2.")
+    assert shopping_app.check_admin_privileges(admin_token)
+    assert shopping_app.check_user_privileges(token)
+    signer.retire("k1")
+    assert not shopping_app.check_user_privileges(token)
+    now[0] += 61
+    assert not shopping_app.check_admin_privileges(admin_token)
+
+
+def test_operations_with_session_token(shopping_app):
+    """Test shopping and editing the catalog on another worker with only the session token"""
+    shopping_app.login("user1", "pass123")
+    token = shopping_app.session_token
+    shopping_app.login("admin", "admin123")
+    admin_token = shopping_app.session_token
+    shopping_app.logout()
+
+    worker = ShoppingApp(tokens=shopping_app.tokens)
+    assert worker.current_user is None
+    assert worker.add_to_cart(1, 2, token=token)
+    assert worker.add_to_cart(2, 1, token=token)
+    assert worker.remove_from_cart(2, token=token)
+    assert worker.get_cart(token).items[1].quantity == 2
+    assert worker.checkout(PaymentMethod.UPI, token=token)
+    assert worker.payments[0].amount == pytest.approx(2 * 199.99)
+    assert not worker.carts["user1"].items
+    assert worker.current_user is None
+
+    # Admins can't shop, users can't edit the catalog, and forged tokens do nothing
+    assert not worker.add_to_cart(1, 1, token=admin_token)
+    assert not worker.add_product("Wool Cap", 4, 19.99, token=token)
+    assert not worker.checkout(PaymentMethod.UPI, token=token + "x")
+    assert worker.add_product("Wool Cap", 4, 19.99, token=admin_token)
+    assert worker.update_product(5, "Wool Cap", 4, 17.99, token=admin_token)
+    assert worker.add_category("Scarves", token=admin_token)
+    assert worker.remove_category(5, token=admin_token)
+    assert worker.remove_product(5, token=admin_token)
+
+
+def test_category_hierarchy(shopping_app):
+    """Test nested categories, subtree queries and subtree removal"""
+    shopping_app.login("admin", "admin123")
+    assert shopping_app.add_category("Outerwear")            # 5
+    assert shopping_app.add_category("Parkas", 5)            # 6
+    assert shopping_app.add_category("Rain Jackets", 5)      # 7
+    assert shopping_app.add_category("Ponchos", 7)           # 8
+    assert not shopping_app.add_category("Orphans", 99)
+    shopping_app.add_product("Arctic Parka", 6, 399.99)      # 5
+    shopping_app.add_product("Storm Shell", 7, 149.99)       # 6
+
+    tree = shopping_app.category_tree
+    assert tree.subtree_ids(5) == [5, 6, 7, 8]
+    assert tree.subtree_ids(7) == [7, 8]
+    assert tree.subtree_ids(1) == [1]
+    outerwear = shopping_app.categories[5]
+    for cid in (6, 7, 8):
+        assert outerwear.left < shopping_app.categories[cid].left < outerwear.right
+    assert [p.name for p in shopping_app.get_subtree_products(5)] == ["Arctic Parka", "Storm Shell"]
+    assert [c.name for c in shopping_app.get_category_path(8)] == ["Outerwear", "Rain Jackets", "Ponchos"]
+
+    # Moving a product updates the subtree index
+    shopping_app.update_product(6, "Storm Shell", 3, 149.99)
+    assert [p.id for p in shopping_app.get_subtree_products(7)] == []
+
+    # Subtrees only go with subtree=True, and only when they hold no products
+    assert not shopping_app.remove_category(7)
+    assert shopping_app.remove_category(7, subtree=True)
+    assert 7 not in shopping_app.categories and 8 not in shopping_app.categories
+    assert tree.subtree_ids(5) == [5, 6]
+    assert not shopping_app.remove_category(5, subtree=True)
+    shopping_app.remove_product(5)
+    assert shopping_app.remove_category(5, subtree=True)
+    assert tree.subtree_ids(4) == [4]
+    assert shopping_app.add_category("Hats", 4)
+    assert tree.subtree_ids(4) == [4, 9]
+
+
+def test_event_bus_unsubscribe_during_publish():
+    """Test that subscribers can come and go while events are being published"""
+    bus = EventBus()
+    seen = []
+    bus.subscribe(lambda event: seen.append(event.seq))
+    stop = threading.Event()
+
+    def publisher():
+        while not stop.is_set():
+            bus.publish(EventType.CART_CLEARED, "cart")
+
+    thread = threading.Thread(target=publisher)
+    thread.start()
+    try:
+        for _ in range(20):
+            subscription = bus.subscribe_batches(lambda batch: None, max_pending=10)
+            handler = bus.subscribe(lambda event: None)
+            bus.unsubscribe(handler)
+            bus.unsubscribe(subscription)  # returns, so the worker thread saw its stop marker
+    finally:
+        stop.set()
+        thread.join()
+    # The first subscriber never missed an event
+    assert seen == list(range(1, len(seen) + 1))
+
+
+def test_event_handlers_can_change_the_shop(shopping_app):
+    """Test that handlers may publish events of their own without deadlocking"""
+    events = []
+
+    def file_new_products(event):
+        # Derived state maintained by calling back into the shop
+        events.append(event)
+        if event.type is EventType.PRODUCT_ADDED:
+            shopping_app.add_category(f"New: {event.data['name']}")
+
+    shopping_app.events.subscribe(file_new_products)
+    shopping_app.login("admin", "admin123")
+    with contextlib.redirect_stdout(io.StringIO()):
+        assert shopping_app.add_product("Silk Scarf", 4, 39.99)
+    assert [e.type for e in events] == [EventType.PRODUCT_ADDED, EventType.CATEGORY_ADDED]
+    assert [e.seq for e in events] == [1, 2]
+    assert shopping_app.categories[5].name == "New: Silk Scarf"
+
+
+def test_batch_subscription_backpressure_is_bounded():
+    """Test that a full batch subscription neither blocks publishers forever nor deadlocks its own handler"""
+    bus = EventBus()
+    release = threading.Event()
+    handled = []
+
+    def slow(batch):
+        release.wait()
+        handled.extend(e.seq for e in batch)
+        if batch[0].seq == 1:
+            # Publishing from the handler while its own queue is full
+            for _ in range(3):
+                bus.publish(EventType.CART_CLEARED, "from-handler")
+
+    subscription = bus.subscribe_batches(slow, max_batch=1, max_pending=1, max_wait=0.05)
+    for _ in range(4):
+        bus.publish(EventType.CART_CLEARED, "cart")
+    # Event 1 is being handled and event 2 is queued; 3 and 4 timed out
+    assert subscription.dropped == 2
+    release.set()
+    subscription.flush()
+    bus.unsubscribe(subscription)
+    assert handled[:2] == [1, 2]
+    assert subscription.dropped + len(handled) == bus.seq == 7
+
+
+def test_checkout_survives_order_queue_failure(shopping_app, tmp_path):
+    """Test that a paid order is kept, not charged twice, when the queue is unavailable"""
+    jobs = JobQueue(str(tmp_path / "orders.sqlite"))
+    shopping_app.order_queue = jobs
+    enqueue = jobs.enqueue
+
+    def locked(payload):
+        raise sqlite3.OperationalError("database is locked")
+
+    jobs.enqueue = locked
+    shopping_app.login("user1", "pass123")
+    shopping_app.add_to_cart(1, 1)
+    assert shopping_app.checkout(PaymentMethod.UPI, idempotency_key="order-1")
+    assert not shopping_app.get_cart().items
+    assert len(shopping_app.pending_orders) == 1
+    # The client's retry is a replay, not a second charge
+    assert shopping_app.checkout(PaymentMethod.UPI, idempotency_key="order-1")
+    assert len(shopping_app.payments) == 1
+
+    jobs.enqueue = enqueue
+    assert shopping_app.flush_pending_orders() == 1
+    assert shopping_app.pending_orders == []
+    assert jobs.pending() == 1
+
+
+def test_concurrent_checkouts_queue_each_order_once(shopping_app, tmp_path):
+    """Test that concurrent checkouts queue every paid order exactly once, even when the queue fails"""
+    jobs = JobQueue(str(tmp_path / "orders.sqlite"))
+    shopping_app.order_queue = jobs
+    shopping_app.pending_orders_path = str(tmp_path / "pending.jsonl")
+    enqueue, calls = jobs.enqueue, itertools.count()
+
+    def flaky(payload):
+        if next(calls) % 3 == 0:
+            raise sqlite3.OperationalError("database is locked")
+        return enqueue(payload)
+
+    jobs.enqueue = flaky
+    errors = []
+
+    def shopper(index):
+        view = session_view(shopping_app)
+        username = f"shopper{index}"
+        shopping_app.users[username] = User(username, "pass", UserType.user)
+        try:
+            view.login(username, "pass")
+            for _ in range(25):
+                view.add_to_cart(1 + index % 4, 1)
+                assert view.checkout(PaymentMethod.UPI)
+        except Exception as e:
+            errors.append(e)
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        threads = [threading.Thread(target=shopper, args=(i,)) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    assert errors == []
+    assert len(shopping_app.payments) == 200
+
+    # A restarted shop picks up the saved orders
+    jobs.enqueue = enqueue
+    restarted = ShoppingApp()
+    restarted.order_queue = jobs
+    restarted.pending_orders_path = shopping_app.pending_orders_path
+    restarted.flush_pending_orders()
+    assert restarted.pending_orders == []
+    order_ids = [job.payload["order_id"] for job in jobs.dequeue(max_jobs=1000)]
+    assert sorted(order_ids) == sorted(payment.order_id for payment in shopping_app.payments)
+
+
+def test_fulfilment_worker_survives_dequeue_errors(tmp_path):
+    """Test that a SQLite error while dequeuing doesn't end a worker"""
+    jobs = JobQueue(str(tmp_path / "jobs.sqlite"))
+    dequeue, calls = jobs.dequeue, []
+
+    def flaky(*args):
+        calls.append(1)
+        if len(calls) == 1:
+            raise sqlite3.OperationalError("database is locked")
+        return dequeue(*args)
+
+    jobs.dequeue = flaky
+    jobs.enqueue({"order_id": 1})
+    handled = []
+    workers = FulfilmentWorkers(jobs, handled.append, workers=1, poll_interval=0.01)
+    workers.start()
+    try:
+        assert workers.drain(timeout=5)
+    finally:
+        workers.stop()
+    assert handled == [{"order_id": 1}]
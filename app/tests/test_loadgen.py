@@ -0,0 +1,49 @@
+import random
+
+from ..app import ShoppingApp
+from ..loadgen import LoadGenerator, ZipfSampler, percentile, seed_catalog
+
+
+def test_zipf_sampler_prefers_low_ranks():
+    """
+    Test that the Zipf sampler favours popular items and stays in range
+    """
+    sampler = ZipfSampler(100, 1.2, random.Random(1))
+    samples = [sampler.sample() for _ in range(5000)]
+    assert all(0 <= s < 100 for s in samples)
+    assert samples.count(0) > samples.count(50) * 10
+
+
+def test_percentile():
+    """
+    Test nearest-rank percentiles
+    """
+    values = [float(v) for v in range(1, 101)]
+    assert percentile(values, 50) == 50.0
+    assert percentile(values, 99) == 99.0
+    assert percentile(values, 99.9) == 100.0
+    assert percentile([], 50) == 0.0
+
+
+def test_load_generator_run():
+    """
+    Test a short load run against an in-process ShoppingApp
+    """
+    shop = ShoppingApp()
+    seed_catalog(shop, 50)
+    assert len(shop.products) == 50
+    assert shop.current_user is None
+
+    mix = {"browse": 20, "add": 40, "remove": 20, "checkout": 20}
+    report = LoadGenerator(shop, shoppers=3, operations=50, zipf_s=1.1, mix=mix, admin_interval=0.001).run()
+    # Every shopper logged in, and the whole mix ran against each shopper's own session
+    assert len(report.latencies["login"]) == 3
+    assert report.failures.get("login", 0) == 0
+    for op in ("browse", "add", "remove", "checkout"):
+        assert len(report.latencies[op]) > 0
+    assert report.failures.get("add", 0) == 0
+    assert report.failures.get("remove", 0) == 0
+    assert report.failures.get("checkout", 0) == 0
+    assert len(shop.payments) == len(report.latencies["checkout"])
+    assert report.throughput > 0
+    assert shop.current_user is None
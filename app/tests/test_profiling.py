@@ -0,0 +1,103 @@
+import io
+
+from ..app import PaymentMethod, ShoppingApp
+from ..loadgen import LoadGenerator, seed_catalog, session_view
+from ..profiling import MemoryAccounting, OperationProfiler
+
+
+def test_operation_profiler():
+    """
+    Test sampling, collapsed-stack export and detaching
+    """
+    shop = ShoppingApp()
+    profiler = OperationProfiler(sample_rate=1.0, operations=("login", "display_catalog", "checkout"))
+    profiler.attach(shop)
+    shop.login("user1", "pass123")
+    shop.add_to_cart(1, 1)
+    shop.display_catalog()
+    shop.checkout(PaymentMethod.UPI)
+    profiler.detach()
+    shop.display_catalog()
+
+    assert profiler.calls == {"login": 1, "display_catalog": 1, "checkout": 1}
+    assert profiler.samples == profiler.calls
+    assert "display_catalog" not in shop.__dict__
+    assert ShoppingApp.display_catalog.__module__ == ShoppingApp.__module__
+    assert profiler.stats("checkout") is not None
+
+    out = io.StringIO()
+    profiler.write_collapsed(out)
+    lines = out.getvalue().splitlines()
+    assert any(line.startswith("checkout;_admitted") for line in lines)
+    for line in lines:
+        stack, micros = line.rsplit(" ", 1)
+        assert stack.split(";")[0] in profiler.calls
+        assert int(micros) > 0
+
+
+def test_operation_profiler_sampling_off():
+    """
+    Test that a zero sample rate profiles nothing
+    """
+    shop = ShoppingApp()
+    profiler = OperationProfiler(sample_rate=0.0)
+    profiler.attach(shop)
+    shop.display_catalog()
+    profiler.detach()
+    assert profiler.calls == {"display_catalog": 1}
+    assert profiler.samples == {}
+    assert profiler.collapsed_stacks() == []
+
+
+def test_operation_profiler_under_load():
+    """
+    Test that session views of a profiled shop keep their own logins and are profiled too
+    """
+    shop = ShoppingApp()
+    seed_catalog(shop, 20)
+    profiler = OperationProfiler(sample_rate=1.0)
+    profiler.attach(shop)
+    try:
+        view = session_view(shop)
+        assert view.login("user1", "pass123")
+        assert view.current_user is not None
+        assert shop.current_user is None
+
+        mix = {"browse": 10, "add": 40, "remove": 25, "checkout": 25}
+        report = LoadGenerator(shop, shoppers=3, operations=40, mix=mix, admin_interval=None).run()
+    finally:
+        profiler.detach()
+    for op in ("add", "remove", "checkout"):
+        assert len(report.latencies[op]) > 0
+    assert report.failures.get("checkout", 0) == 0
+    assert profiler.calls["login"] == 4
+    assert profiler.calls["checkout"] == len(report.latencies["checkout"])
+    assert profiler.samples["remove_from_cart"] == len(report.latencies["remove"])
+    # Detaching put the class back as it was
+    assert ShoppingApp.login.__module__ == ShoppingApp.__module__
+    assert "_profiler" not in shop.__dict__
+
+
+def test_memory_accounting():
+    """
+    Test attributing allocations to carts, sessions, catalog and payments
+    """
+    accounting = MemoryAccounting()
+    accounting.start()
+    try:
+        shop = ShoppingApp()
+        shop.login("admin", "admin123")
+        for i in range(50):
+            shop.add_product(f"Product {i}", 1, 9.99)
+        shop.logout()
+        shop.login("user1", "pass123")
+        for product_id in range(5, 55):
+            shop.add_to_cart(product_id, 1)
+        shop.checkout(PaymentMethod.UPI)
+        totals = accounting.snapshot()
+    finally:
+        accounting.stop()
+    assert set(totals) == {"carts", "sessions", "catalog", "payments", "other"}
+    assert totals["catalog"] > 0
+    assert totals["sessions"] > 0
+    assert totals["payments"] > 0
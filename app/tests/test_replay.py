@@ -0,0 +1,107 @@
+import io
+import json
+
+import pytest
+from ..app import PaymentMethod, ShoppingApp
+from ..replay import (
+    RecordingShop,
+    TraceError,
+    load_trace,
+    replay,
+    summarize,
+)
+
+TRACE = """
+# a user shops, then an admin edits the catalog
+{"op": "login", "args": {"username": "user1", "password": "pass123"}}
+{"op": "add_to_cart", "args": {"product_id": 1, "quantity": 2}}
+{"op": "add_to_cart", "args": {"product_id": 999, "quantity": 1}}
+{"op": "checkout", "args": {"payment_method": "UPI"}}
+{"op": "logout"}
+{"op": "login", "args": {"username": "admin", "password": "admin123"}}
+{"op": "add_product", "args": {"name": "Wool Cap", "category_id": 4, "price": 19.99}}
+{"op": "display_catalog"}
+"""
+
+
+def test_replay_trace():
+    """
+    Test replaying a trace against a fresh ShoppingApp
+    """
+    shop = ShoppingApp()
+    results = replay(shop, load_trace(io.StringIO(TRACE)))
+    assert [r.ok for r in results] == [True, True, False, True, True, True, True, True]
+    assert shop.products[5].name == "Wool Cap"
+
+    summary = summarize(results)
+    assert summary["add_to_cart"]["count"] == 2
+    assert summary["add_to_cart"]["failed"] == 1
+    assert summary["login"]["mean"] >= 0
+
+
+def test_replay_rejects_unknown_operation():
+    """
+    Test that malformed traces are reported
+    """
+    with pytest.raises(TraceError):
+        list(load_trace(io.StringIO('{"op": "drop_tables"}\n')))
+    with pytest.raises(TraceError):
+        replay(ShoppingApp(), [{"op": "login", "args": {"username": "user1"}}])
+    with pytest.raises(TraceError, match="line 2: checkout: unknown payment method"):
+        replay(ShoppingApp(), [
+            {"op": "login", "args": {"username": "user1", "password": "pass123"}},
+            {"op": "checkout", "args": {"payment_method": "Bitcoin"}},
+        ])
+    with pytest.raises(TraceError, match="line 1: add_to_cart: args must be an object"):
+        replay(ShoppingApp(), [{"op": "add_to_cart", "args": [1, 2]}])
+
+
+def test_replay_rejects_malformed_arguments():
+    """
+    Test that records with badly typed or unknown arguments are reported before they reach the shop
+    """
+    login = {"op": "login", "args": {"username": "user1", "password": "pass123"}}
+    with pytest.raises(TraceError, match="line 2: add_to_cart: quantity has the wrong type"):
+        replay(ShoppingApp(), [login, {"op": "add_to_cart", "args": {"product_id": 1, "quantity": "2"}}])
+    with pytest.raises(TraceError, match="line 2: add_to_cart: product_id has the wrong type"):
+        replay(ShoppingApp(), [login, {"op": "add_to_cart", "args": {"product_id": True, "quantity": 2}}])
+    with pytest.raises(TraceError, match="line 2: add_to_cart: unknown arguments colour"):
+        replay(ShoppingApp(), [login, {"op": "add_to_cart", "args": {"product_id": 1, "quantity": 2, "colour": "red"}}])
+    with pytest.raises(TraceError, match="line 1: unknown operation"):
+        replay(ShoppingApp(), [{"op": "drop_tables"}])
+    with pytest.raises(TraceError, match="line 1: unknown operation"):
+        replay(ShoppingApp(), ["login"])
+    # Ints are accepted for prices, and optional arguments may be null where the app allows it
+    shop = ShoppingApp()
+    results = replay(shop, [
+        {"op": "login", "args": {"username": "admin", "password": "admin123"}},
+        {"op": "add_product", "args": {"name": "Wool Cap", "category_id": 4, "price": 20}},
+        {"op": "add_category", "args": {"name": "Scarves", "parent_id": None}},
+    ])
+    assert all(r.ok for r in results)
+
+
+def test_recording_round_trip():
+    """
+    Test that a recorded session replays to the same state
+    """
+    out = io.StringIO()
+    shop = RecordingShop(ShoppingApp(), out)
+    shop.login("user1", "pass123")
+    shop.add_to_cart(2, 3)
+    shop.checkout(PaymentMethod.PAYPAL)
+    shop.add_to_cart(1, 1)
+    shop.checkout(PaymentMethod.UPI, idempotency_key="order-1")
+    shop.checkout(payment_method=PaymentMethod.UPI, idempotency_key="order-1")
+    assert shop.current_user.username == "user1"
+
+    lines = out.getvalue().splitlines()
+    assert json.loads(lines[2]) == {"op": "checkout", "args": {"payment_method": "PAYPAL"}}
+    assert json.loads(lines[-1]) == {
+        "op": "checkout", "args": {"payment_method": "UPI", "idempotency_key": "order-1"}
+    }
+    replayed = ShoppingApp()
+    results = replay(replayed, load_trace(io.StringIO(out.getvalue())))
+    assert all(r.ok for r in results)
+    # The retried checkout is replayed as a retry, not a second charge
+    assert len(replayed.payments) == 2